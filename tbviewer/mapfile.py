@@ -9,27 +9,54 @@
 
 """Ozy's map file loader/creator & calibration functions."""
 
+import itertools
 import logging
 import math
+import re
 
 from . import formatting
 from .errors import InvalidFileException
 
 _LOG = logging.getLogger(__name__)
 
+# image corners
+_NW, _NE, _SE, _SW = range(4)
+
+# length of one degree on the WGS 84 equator, in meters
+_METERS_PER_DEG = math.pi / 180.0 * 6378137.0
+
 
 class Point:
     """Point on map."""
 
+    __slots__ = ('idx', 'x', 'y', 'lat', 'lon', '_minsec')
+
     def __init__(self, x, y, lon, lat, idx=None):
         self.idx = idx
         self.x = x
         self.y = y
         self.lat = lat
         self.lon = lon
+        # (lat, lon, result) cached by minsec()
+        self._minsec = None
 
     def __repr__(self):
-        return formatting.prettydict(self.__dict__)
+        return formatting.prettydict(
+            {key: getattr(self, key) for key in self.__slots__
+             if key[0] != '_'})
+
+    def minsec(self):
+        """Get (lat_m, lat_s, lat_d, lon_m, lon_s, lon_d) for point.
+
+        Result is cached until lat or lon change.
+        """
+        cached = self._minsec
+        if cached is None or cached[0] != self.lat or cached[1] != self.lon:
+            cached = self._minsec = (
+                self.lat, self.lon,
+                _degree2minsec(self.lat, 'S', 'N') +
+                _degree2minsec(self.lon, 'W', 'E'))
+        return cached[2]
 
 
 def _degree2minsec(d, lz='S', gz='N'):
@@ -62,6 +89,8 @@ class MapFile():
         self.mm1b = None
         self.image_width = None
         self.image_height = None
+        # (inputs, result) of last _projection_coefs call
+        self._projection = None
 
     def __str__(self):
         return "<MapMeta {}>".format(", ".join(
@@ -73,108 +102,92 @@ class MapFile():
     def parse_map(self, content):
         """Parse content of .map file."""
         self.clear()
-        content = [line.strip() for line in content.split("\n")]
-        if content[0] != 'OziExplorer Map Data File Version 2.2':
+        # lines are not stripped here; trailing '\r' of CRLF files is
+        # skipped by int() / float() or stripped where text is compared
+        lines = content.split("\n")
+        header = lines[0].strip()
+        if header != 'OziExplorer Map Data File Version 2.2':
             raise InvalidFileException(
-                "Wrong .map file - wrong header %r" % content[0])
+                "Wrong .map file - wrong header %r" % header)
 
-        if len(content) < 10:
+        if len(lines) < 10:
             raise InvalidFileException("Wrong .map file - too short")
 
-        self.img_filename = content[1]
-        self.img_filepath = content[2]
+        self.img_filename = lines[1].strip()
+        self.img_filepath = lines[2].strip()
         # line 3 - skip
-        self.projection = content[4]
+        self.projection = lines[4].strip()
         # line 5-6 - reserverd
         # line 7 - Magnetic variation
-        self.map_projection = content[8]
-
-        for line in content[9:]:
+        self.map_projection = lines[8].strip()
+
+        for line in itertools.islice(lines, 9, None):
+            match = _TAG_RE.match(line)
+            if not match:
+                continue
+            maxsplit, handler = _LINE_HANDLERS[match.group('tag')]
+            fields = line.split(',', maxsplit)
             try:
-                if line.startswith("Point"):
-                    point = _parse_point(line)
-                    if point:
-                        self.points.append(point)
-                elif line.startswith('IWH,Map Image Width/Height,'):
-                    self.image_width, self.image_height = \
-                        map(int, line[27:].split(','))
-                elif line.startswith('MMPNUM,'):
-                    self.mmpnum = int(line[7:])
-                elif line.startswith('MMPLL'):
-                    point_id, lon, lat = _parse_mmpll(line)
-                    if point_id - 1 != len(self.mmpll):
-                        raise InvalidFileException("Invalid MMPLL point id")
-                    self.mmpll.append((lon, lat))
-                elif line.startswith('MMPXY'):
-                    point_id, x, y = _parse_mmpxy(line)
-                    if point_id - 1 != len(self.mmpxy):
-                        _LOG.warn("parse mmpxy error: %r", line)
-                        raise InvalidFileException("Invalid MMPXY point index")
-                    self.mmpxy.append((x, y))
-                elif line.startswith('MM1B,'):
-                    self.mm1b = float(line[5:])
+                handler(self, fields)
             except ValueError as err:
                 raise InvalidFileException(
-                    f"Error loading line '{line}': {err}")
+                    f"Error loading line '{line.strip()}': {err}")
 
     def to_str(self):
-        points = []
-        for idx, p in enumerate(self.points):
-            _LOG.debug("Point %r", p)
-            lat_m, lat_s, lat_d = _degree2minsec(p.lat, 'S', 'N')
-            lon_m, lon_s, lon_d = _degree2minsec(p.lon, 'W', 'E')
-            points.append(_MAP_POINT_TEMPLATE.format(
-                idx=idx, x=int(p.x), y=int(p.y),
-                lat_m=lat_m, lat_s=lat_s, lat_d=lat_d,
-                lon_m=lon_m, lon_s=lon_s, lon_d=lon_d
-            ))
-        mmpxy = [_MAP_MMPXY_TEMPLATE.format(idx=idx+1, x=x, y=y)
-                 for idx, (x, y) in enumerate(self.mmpxy)]
-        mmpll = [_MAP_MMPLL_TEMPLATE.format(idx=idx+1, lat=lat, lon=lon)
-                 for idx, (lon, lat) in enumerate(self.mmpll)]
         img_filename = self.img_filename or "dummy.jpg"
         return _MAP_TEMPALTE.format(
             img_filename=img_filename,
             img_filepath=self.img_filepath or img_filename,
-            points="\n".join(points),
-            mmplen=len(mmpxy),
-            mmpxy="\n".join(mmpxy),
-            mmpll="\n".join(mmpll),
+            points="\n".join(
+                _format_point(idx, int(p.x), int(p.y), *p.minsec())
+                for idx, p in enumerate(self.points)),
+            mmplen=len(self.mmpxy),
+            mmpxy="\n".join(
+                _format_mmpxy(idx, x, y)
+                for idx, (x, y) in enumerate(self.mmpxy, 1)),
+            mmpll="\n".join(
+                _format_mmpll(idx, lon, lat)
+                for idx, (lon, lat) in enumerate(self.mmpll, 1)),
             mm1b=self.mm1b,
             image_width=self.image_width,
             image_height=self.image_height
         )
 
     def set_points(self, points):
-        """Set calibration points."""
-        _LOG.debug("points: %r", points)
-        self.points = points
+        """Set calibration points.
+
+        `points` may contain Point objects or (x, y, lon, lat) tuples;
+        tuples are converted to Points indexed by their position.
+        """
+        self.points = [
+            p if isinstance(p, Point) else Point(*p, idx=idx)
+            for idx, p in enumerate(points)
+        ]
+        _LOG.debug("points: %r", self.points)
 
     def calibrate(self):
         """Calibrate map according to given points."""
-        points = _calibrate_calculate(self.points, self.image_width,
-                                      self.image_height)
-        self.mmpll = []
-        self.mmpxy = []
-        for p in points:
-            self.mmpxy.append((p.x, p.y))
-            self.mmpll.append((p.lon, p.lat))
-
-        _LOG.debug("mmpll: %r", self.mmpll)
-
-        self.mmpnum = len(self.mmpll)
+        width, height = self.image_width, self.image_height
+        mmpll = _calibrate_calculate(self.points, width, height)
+        _LOG.debug("mmpll: %r", mmpll)
 
         # calc MM1B - The scale of the image meters/pixel, its
         # calculated in the left / right image direction.
-        lon_w_avg = (self.mmpll[0][0] + self.mmpll[3][0]) / 2
-        lon_e_avg = (self.mmpll[1][0] + self.mmpll[2][0]) / 2
-        lat_avg = (self.mmpll[0][1] + self.mmpll[3][1] +
-                   self.mmpll[1][1] + self.mmpll[2][1]) / 4
+        (lon0, lat0), (lon1, lat1), (lon2, lat2), (lon3, lat3) = mmpll
+        lon_w_avg = (lon0 + lon3) / 2
+        lon_e_avg = (lon1 + lon2) / 2
+        lat_avg = (lat0 + lat3 + lat1 + lat2) / 4
         d_lon = lon_e_avg - lon_w_avg
-        d_lon_dist = abs(d_lon * math.pi / 180.0 * 6378137.0 *
+        d_lon_dist = abs(d_lon * _METERS_PER_DEG *
                          math.cos(math.radians(lat_avg)))
 
-        self.mm1b = d_lon_dist / self.image_width
+        mm1b = d_lon_dist / width
+
+        # nw, ne, se, sw
+        self.mmpxy = [(0, 0), (width, 0), (width, height), (0, height)]
+        self.mmpll = mmpll
+        self.mmpnum = len(mmpll)
+        self.mm1b = mm1b
 
     def validate(self):
         """Check is mapfile is valid."""
@@ -183,98 +196,173 @@ class MapFile():
 
     def xy2latlon(self, x, y):
         """Get geo location for given pixel coordinates."""
+        projection = self._get_projection()
+        if not projection:
+            return None
+        return _map_xy_lonlat(projection, x, y)
+
+    def _get_projection(self):
         if not self.mmpll:
             return None
-        return _map_xy_lonlat(
-            self.mmpll[0], self.mmpll[1], self.mmpll[2], self.mmpll[3],
-            self.image_width, self.image_height,
-            x, y)
+        # mmpll and image size may be changed directly by callers, so
+        # cached coefficients are reused only for the same inputs
+        inputs = (*self.mmpll[:4], self.image_width, self.image_height)
+        if self._projection is None or self._projection[0] != inputs:
+            self._projection = (inputs, _projection_coefs(*inputs))
+        return self._projection[1]
+
 
+# sign of point coordinates by hemisphere field; other values keep sign
+_LAT_SIGN = {'N': 1, 'S': -1}
+_LON_SIGN = {'E': -1, 'W': 1}
 
-def _parse_point(line):
-    _LOG.debug("_parse_point %r", line)
-    fields = line.split(',')
+
+def _parse_point(fields):
     if fields[2].strip() == "":
         return None
-    point = Point(
+    return Point(
         x=int(fields[2]),
         y=int(fields[3]),
-        lat=int(fields[6]) + float(fields[7]) / 60.,
-        lon=int(fields[9]) + float(fields[10]) / 60.)
-    point.idx = int(fields[0][5:])
-    if fields[8] == 'E':
-        point.lon *= -1
-    if fields[11] == 'S':
-        point.lat *= -1
-    return point
-
-
-def _parse_mmpxy(line):
-    fields = line.split(',')
+        lat=(int(fields[6]) + float(fields[7]) / 60.) *
+        _LAT_SIGN.get(fields[11].strip(), 1),
+        lon=(int(fields[9]) + float(fields[10]) / 60.) *
+        _LON_SIGN.get(fields[8].strip(), 1),
+        idx=int(fields[0].lstrip()[5:]))
+
+
+def _parse_mmpxy(fields):
     if len(fields) != 4:
         raise InvalidFileException(
             "Wrong .map file - wrong number of fields in MMPXY field %r"
-            % line)
-    _, point_id, x, y = [field.strip() for field in fields]
+            % ','.join(fields))
+    _, point_id, x, y = fields
     try:
         point_id = int(point_id)
         x = int(x)
         y = int(y)
     except ValueError as err:
         raise InvalidFileException(
-            "Wrong .map file - wrong MMPXY field %r; %s" % (line, err))
+            "Wrong .map file - wrong MMPXY field %r; %s"
+            % (','.join(fields), err))
     return point_id, x, y
 
 
-def _parse_mmpll(line):
-    fields = line.split(',')
+def _parse_mmpll(fields):
     if len(fields) != 4:
         raise InvalidFileException(
             "Wrong .map file - wrong number of fields in MMPLL field %r"
-            % line)
-    _, point_id, lon, lat = [field.strip() for field in fields]
+            % ','.join(fields))
+    _, point_id, lon, lat = fields
     try:
         point_id = int(point_id)
         lon = float(lon)
         lat = float(lat)
     except ValueError as err:
         raise InvalidFileException(
-            "Wrong .map file - wrong MMPLL field %r; %s" % (line, err))
+            "Wrong .map file - wrong MMPLL field %r; %s"
+            % (','.join(fields), err))
     return point_id, lon, lat
 
 
-def _sort_points(positions, width, height):
-    if not positions or len(positions) < 2:
-        return []
+def _handle_point(mapfile, fields):
+    point = _parse_point(fields)
+    if point:
+        mapfile.points.append(point)
+
+
+def _handle_iwh(mapfile, fields):
+    if fields[1] == 'Map Image Width/Height':
+        mapfile.image_width, mapfile.image_height = map(int, fields[2:])
 
-    def dist_from(pos, x0, y0):
-        return math.sqrt((pos.x - x0) ** 2 + (pos.y - y0) ** 2)
 
-    # north, w-e
-    t_pos = sorted(positions, key=lambda x: dist_from(x, 0, 0))
-    n_nw = t_pos[0]
-    n_ne = sorted(t_pos[1:], key=lambda x: dist_from(x, width, 0))[0]
-    top = (n_nw, n_ne)
+def _handle_mmpnum(mapfile, fields):
+    mapfile.mmpnum = int(fields[1])
 
-    # south, w-e
-    t_pos = sorted(positions, key=lambda x: dist_from(x, 0, height))
-    s_sw = t_pos[0]
-    s_se = sorted(t_pos[1:], key=lambda x: dist_from(x, width, height))[0]
-    bottom = (s_sw, s_se)
 
-    # west, n-s
-    t_pos = sorted(positions, key=lambda x: dist_from(x, 0, 0))
-    w_nw = t_pos[0]
-    w_sw = sorted(t_pos[1:], key=lambda x: dist_from(x, 0, height))[0]
-    left = (w_nw, w_sw)
+def _handle_mmpll(mapfile, fields):
+    point_id, lon, lat = _parse_mmpll(fields)
+    if point_id - 1 != len(mapfile.mmpll):
+        raise InvalidFileException("Invalid MMPLL point id")
+    mapfile.mmpll.append((lon, lat))
 
-    # east, n-s
-    t_pos = sorted(positions, key=lambda x: dist_from(x, width, 0))
-    e_ne = t_pos[0]
-    e_se = sorted(t_pos[1:], key=lambda x: dist_from(x, width, height))[0]
-    right = (e_ne, e_se)
 
-    return (left, right, top, bottom)
+def _handle_mmpxy(mapfile, fields):
+    point_id, x, y = _parse_mmpxy(fields)
+    if point_id - 1 != len(mapfile.mmpxy):
+        _LOG.warn("parse mmpxy error: %r", ','.join(fields))
+        raise InvalidFileException("Invalid MMPXY point index")
+    mapfile.mmpxy.append((x, y))
+
+
+def _handle_mm1b(mapfile, fields):
+    mapfile.mm1b = float(fields[1])
+
+
+# record tag -> (maxsplit, handler(mapfile, fields)); fields after
+# `maxsplit` are not used and left unsplit
+_LINE_HANDLERS = {
+    'Point': (12, _handle_point),
+    'IWH': (-1, _handle_iwh),
+    'MMPNUM': (-1, _handle_mmpnum),
+    'MMPLL': (4, _handle_mmpll),
+    'MMPXY': (4, _handle_mmpxy),
+    'MM1B': (-1, _handle_mm1b),
+}
+
+# record tag (_LINE_HANDLERS key) at the beginning of line; Point tags
+# carry the point number (Point01, Point02, ...), which is not part of tag
+_TAG_RE = re.compile(r'\s*(?P<tag>Point|IWH|MMPNUM|MMPLL|MMPXY|MM1B)\d*,')
+
+
+def _sq_dist(pos, x0, y0):
+    # squared distance - ordering is the same as for euclidean one
+    dx = pos.x - x0
+    dy = pos.y - y0
+    return dx * dx + dy * dy
+
+
+def _sort_points(positions, width, height):
+    if not positions or len(positions) < 2:
+        return []
+
+    corners = {
+        _NW: (0, 0), _NE: (width, 0), _SE: (width, height), _SW: (0, height),
+    }
+    # (first, second) corner of left, right, top and bottom edge. First
+    # point is the nearest to first corner; second - the nearest other
+    # point to second corner, ties resolved by distance to first corner,
+    # then by order.
+    edges = ((_NW, _SW), (_NE, _SE), (_NW, _NE), (_SW, _SE))
+
+    # (corner, tie-break corner) -> two nearest ((distance, tie distance),
+    # point), found in one pass
+    unset = ((math.inf, math.inf), None)
+    best = {}
+    for first, second in edges:
+        best[first, first] = [unset, unset]
+        best[second, first] = [unset, unset]
+    for pos in positions:
+        dists = {corner: _sq_dist(pos, x0, y0)
+                 for corner, (x0, y0) in corners.items()}
+        for (corner, tie), top2 in best.items():
+            dist = (dists[corner], dists[tie])
+            if dist < top2[0][0]:
+                top2[1] = top2[0]
+                top2[0] = (dist, pos)
+            elif dist < top2[1][0]:
+                top2[1] = (dist, pos)
+
+    def nearest(corner, tie, skip=None):
+        first, second = best[corner, tie]
+        return second[1] if first[1] is skip else first[1]
+
+    res = []
+    for first, second in edges:
+        pos = nearest(first, first)
+        res.append((pos, nearest(second, first, pos)))
+
+    # left, right, top, bottom
+    return tuple(res)
 
 
 def _calibrate_calculate(positions, width, height):
@@ -309,43 +397,55 @@ def _calibrate_calculate(positions, width, height):
     se_lat = ne_lat + ds * height
     _LOG.debug("right: %r ds=%r", right, ds)
 
-    res = [
-        Point(0,     0,      nw_lon, nw_lat, 0),  # nw
-        Point(width, 0,      ne_lon, ne_lat, 1),  # ne
-        Point(width, height, se_lon, se_lat, 2),  # se
-        Point(0,     height, sw_lon, sw_lat, 3)  # sw
-    ]
+    # (lon, lat) of image corners: nw, ne, se, sw
+    res = [(nw_lon, nw_lat), (ne_lon, ne_lat), (se_lon, se_lat),
+           (sw_lon, sw_lat)]
     _LOG.debug("_calibrate_calculate %r", res)
     return res
 
 
-def _map_xy_lonlat(xy0, xy1, xy2, xy3, sx, sy, x, y):
+def _projection_coefs(xy0, xy1, xy2, xy3, sx, sy):
     x0, y0 = xy0
     x1, y1 = xy1
     x2, y2 = xy2
     x3, y3 = xy3
-
-    syy = sy - y
-    sxx = sx - x
-
-    return _intersect_lines(
-        (syy * x0 + y * x3) / sy, (syy * y0 + y * y3) / sy,
-        (syy * x1 + y * x2) / sy, (syy * y1 + y * y2) / sy,
-        (sxx * x0 + x * x1) / sx, (sxx * y0 + x * y1) / sx,
-        (sxx * x3 + x * x2) / sx, (sxx * y3 + x * y2) / sx)
-
-
-def _det(a, b, c, d):
-    return a * d - b * c
-
-
-def _intersect_lines(x1, y1, x2, y2, x3, y3, x4, y4):
-    d = _det(x1 - x2, y1 - y2, x3 - x4, y3 - y4) or 1
-    d1 = _det(x1, y1, x2, y2)
-    d2 = _det(x3, y3, x4, y4)
-    px = _det(d1, x1 - x2, d2, x3 - x4) / d
-    py = _det(d1, y1 - y2, d2, y3 - y4) / d
-    return px, py
+    return (
+        x0, y0, x1, y1, x3, y3,
+        x3 - x0, y3 - y0,  # west edge
+        x2 - x1, y2 - y1,  # east edge
+        x1 - x0, y1 - y0,  # north edge
+        x2 - x3, y2 - y3,  # south edge
+        1.0 / sx, 1.0 / sy,
+    )
+
+
+def _map_xy_lonlat(projection, x, y):
+    x0, y0, x1, y1, x3, y3, west_dx, west_dy, east_dx, east_dy, \
+        north_dx, north_dy, south_dx, south_dy, inv_sx, inv_sy = projection
+
+    # line a-b between west and east edge at height y
+    t = y * inv_sy
+    a_x = x0 + west_dx * t
+    a_y = y0 + west_dy * t
+    b_x = x1 + east_dx * t
+    b_y = y1 + east_dy * t
+    # line c-d between north and south edge at width x
+    u = x * inv_sx
+    c_x = x0 + north_dx * u
+    c_y = y0 + north_dy * u
+    d_x = x3 + south_dx * u
+    d_y = y3 + south_dy * u
+
+    # intersection of the lines
+    ab_x = a_x - b_x
+    ab_y = a_y - b_y
+    cd_x = c_x - d_x
+    cd_y = c_y - d_y
+    det = ab_x * cd_y - ab_y * cd_x or 1
+    det_ab = a_x * b_y - a_y * b_x
+    det_cd = c_x * d_y - c_y * d_x
+    return (det_ab * cd_x - ab_x * det_cd) / det, \
+        (det_ab * cd_y - ab_y * det_cd) / det
 
 
 # def distance(lat1, lon1, lat2, lon2):
@@ -358,12 +458,19 @@ def _intersect_lines(x1, y1, x2, y2, x3, y3, x4, y4):
 #     return 12742. * math.atan2(math.sqrt(a), math.sqrt(1 - a))
 
 
-_MAP_POINT_TEMPLATE = \
-    "Point{idx:02d},xy,{x:>5},{y:>5},in, deg,{lat_m:>4},{lat_s:3.7f},{lat_d},"\
-    "{lon_m:>4},{lon_s:3.7f},{lon_d}, grid,   ,           ,           ,N"
+def _format_point(idx, x, y, lat_m, lat_s, lat_d, lon_m, lon_s, lon_d):
+    return f"Point{idx:02d},xy,{x:>5},{y:>5},in, deg,"\
+        f"{lat_m:>4},{lat_s:3.7f},{lat_d},{lon_m:>4},{lon_s:3.7f},{lon_d},"\
+        " grid,   ,           ,           ,N"
+
+
+def _format_mmpxy(idx, x, y):
+    return f"MMPXY,{idx},{x},{y}"
+
+
+def _format_mmpll(idx, lon, lat):
+    return f"MMPLL,{idx},{lon:3.7f},{lat:3.7f}"
 
-_MAP_MMPXY_TEMPLATE = "MMPXY,{idx},{x},{y}"
-_MAP_MMPLL_TEMPLATE = "MMPLL,{idx},{lon:3.7f},{lat:3.7f}"
 
 _MAP_TEMPALTE = """OziExplorer Map Data File Version 2.2
 {img_filename}
@@ -550,9 +550,8 @@ class WndCalibrate(tk.Tk):
         self._map_file.image_height = self._img.height()
         self._map_file.img_filename = self._img_filename
         self._map_file.img_filepath = os.path.dirname(self._img_filename)
-        points = [mapfile.Point(x=p.x, y=p.y, lon=p.lon, lat=p.lat, idx=idx)
-                  for idx, p in enumerate(self._positions_data)]
-        self._map_file.set_points(points)
+        self._map_file.set_points(
+            (p.x, p.y, p.lon, p.lat) for p in self._positions_data)
         self._map_file.calibrate()
 
         content = self._map_file.to_str()